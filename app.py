@@ -3,6 +3,10 @@ from twilio.twiml.messaging_response import MessagingResponse
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from itsdangerous import URLSafeSerializer, BadSignature
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as EsperaAgotada
+from collections import OrderedDict
+import threading
+import time
 import os
 import requests
 import phonenumbers
@@ -17,6 +21,12 @@ app = Flask(__name__)
 SECRET_KEY = os.environ.get("SECRET_KEY", "clave-secreta-segura")
 serializer = URLSafeSerializer(SECRET_KEY)
 IPQUALITY_API_KEY = os.environ.get("IPQUALITY_API_KEY")
+IPQUALITY_TIMEOUT = 5
+IPQUALITY_VIGENCIA = 600
+IPQUALITY_HILOS = 4
+# Igual al número de hilos: una consulta nunca espera en cola detrás de otras
+IPQUALITY_MAX_PENDIENTES = IPQUALITY_HILOS
+IPQUALITY_MAX_VERIFICACIONES = 5000
 
 # ---------------------------
 # Configuración de la base de datos PostgreSQL
@@ -57,12 +67,72 @@ def ip_es_vpn(ip):
         return False
     try:
         url = f"https://ipqualityscore.com/api/json/ip/{IPQUALITY_API_KEY}/{ip}"
-        res = requests.get(url)
+        res = requests.get(url, timeout=IPQUALITY_TIMEOUT)
         data = res.json()
         return data.get("proxy") or data.get("vpn") or data.get("tor")
     except:
         return False
 
+# ---------------------------
+# Verificación de IP en segundo plano
+# ---------------------------
+# La consulta se inicia al validar el token en /votar y su resultado se
+# reutiliza en /enviar_voto mientras siga vigente, para no esperar dos veces
+# a IPQualityScore. Cada resultado queda asociado al número firmado y a la IP,
+# y se descarta una vez registrado el voto.
+# Si hay demasiadas consultas pendientes o guardadas no se inicia ninguna y el
+# envío hace la verificación de forma síncrona.
+# Los resultados se guardan en memoria de cada proceso de gunicorn: con varios
+# workers el envío puede llegar a uno sin la entrada y entonces también verifica
+# de forma síncrona, así que la mejora no está garantizada en cada voto.
+verificador_ip = ThreadPoolExecutor(max_workers=IPQUALITY_HILOS)
+verificaciones_ip = OrderedDict()
+verificaciones_ip_lock = threading.Lock()
+verificaciones_pendientes = 0
+
+def terminar_verificacion_ip(futuro):
+    global verificaciones_pendientes
+    with verificaciones_ip_lock:
+        verificaciones_pendientes -= 1
+
+def iniciar_verificacion_ip(numero, ip):
+    global verificaciones_pendientes
+    ahora = time.monotonic()
+    clave = (numero, ip)
+    with verificaciones_ip_lock:
+        # Las entradas están en orden de inserción: basta con quitar las más antiguas
+        while verificaciones_ip:
+            inicio, _ = next(iter(verificaciones_ip.values()))
+            if ahora - inicio <= IPQUALITY_VIGENCIA:
+                break
+            verificaciones_ip.popitem(last=False)
+        if clave in verificaciones_ip:
+            return verificaciones_ip[clave][1]
+        if (len(verificaciones_ip) >= IPQUALITY_MAX_VERIFICACIONES
+                or verificaciones_pendientes >= IPQUALITY_MAX_PENDIENTES):
+            return None
+        verificaciones_pendientes += 1
+        futuro = verificador_ip.submit(ip_es_vpn, ip)
+        verificaciones_ip[clave] = (ahora, futuro)
+    futuro.add_done_callback(terminar_verificacion_ip)
+    return futuro
+
+def obtener_verificacion_ip(numero, ip):
+    with verificaciones_ip_lock:
+        entrada = verificaciones_ip.get((numero, ip))
+    if entrada and time.monotonic() - entrada[0] <= IPQUALITY_VIGENCIA:
+        # Se espera a la consulta ya iniciada en lugar de repetirla; si no
+        # responde a tiempo se trata igual que un fallo de ip_es_vpn
+        try:
+            return entrada[1].result(timeout=IPQUALITY_TIMEOUT)
+        except EsperaAgotada:
+            return False
+    return ip_es_vpn(ip)
+
+def descartar_verificacion_ip(numero, ip):
+    with verificaciones_ip_lock:
+        verificaciones_ip.pop((numero, ip), None)
+
 # ---------------------------
 # Página de inicio
 # ---------------------------
@@ -133,7 +203,12 @@ def votar():
     ip = x_forwarded_for.split(',')[0].strip() if x_forwarded_for else request.remote_addr
 
 
-    if ip_es_vpn(ip):
+    # La verificación de VPN se inicia sin esperarla y el formulario se muestra
+    # de inmediato. Solo se rechaza aquí si ya hay un resultado (p. ej. al
+    # recargar la página); en otro caso el rechazo ocurre en /enviar_voto,
+    # después de que el votante haya llenado el formulario.
+    verificacion = iniciar_verificacion_ip(numero, ip)
+    if verificacion and verificacion.done() and verificacion.result():
         return "No se permite votar desde conexiones de VPN o proxy. Por favor, desactiva tu VPN."
 
     votos_misma_ip = Voto.query.filter_by(ip=ip).count()
@@ -182,7 +257,7 @@ def votar():
         """
 
 
-    return render_template("votar.html", numero=numero)
+    return render_template("votar.html", numero=numero, token=token)
 
 # ---------------------------
 # Procesar el voto
@@ -190,6 +265,7 @@ def votar():
 @app.route('/enviar_voto', methods=['POST'])
 def enviar_voto():
     numero = request.form.get('numero')
+    token = request.form.get('token')
     ci = request.form.get('ci')
     candidato = request.form.get('candidato')
     pais = request.form.get('pais')
@@ -222,7 +298,14 @@ def enviar_voto():
 
     if Voto.query.filter_by(numero=numero).first():
         return "Ya registramos tu voto."
-    if ip_es_vpn(ip):
+
+    # Solo se reutiliza la verificación previa si el token firmado corresponde al número
+    try:
+        numero_token = serializer.loads(token) if token else None
+    except BadSignature:
+        numero_token = None
+    es_vpn = obtener_verificacion_ip(numero, ip) if numero_token == numero else ip_es_vpn(ip)
+    if es_vpn:
         return "Voto denegado. No se permite votar desde una VPN o proxy."
     votos_misma_ip = Voto.query.filter_by(ip=ip).count()
     if votos_misma_ip >= 10:
@@ -243,6 +326,7 @@ def enviar_voto():
     )
     db.session.add(nuevo_voto)
     db.session.commit()
+    descartar_verificacion_ip(numero, ip)
 
     return f"""
     <!DOCTYPE html>